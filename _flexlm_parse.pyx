@@ -0,0 +1,96 @@
+# cython: language_level=2
+'''
+Optional Cython accelerator for lminfo.ParseFlexlm._process_details.
+
+The details parse loop is pure string ops and dict inserts, which is exactly
+the kind of code Cython speeds up well on very large license servers (tens of
+thousands of concurrent checkouts).  This module mirrors the pure-Python loop
+in lminfo.py line for line; lminfo imports it if available and silently falls
+back to the Python version otherwise.  Keep the two in sync when the parse
+logic changes.
+
+Build in place with:
+
+    pip install cython
+    cythonize -i _flexlm_parse.pyx
+'''
+
+import re
+
+# Keep in sync with lminfo._USERS_RE
+_USERS_RE = re.compile(r"Users of (\S+):\s+\(Total of (\d+) licenses? issued;  "
+                       r"Total of (\d+) licenses? in use\)")
+
+
+def process_details(raw_det, dict lminfo, int yyyy, int curr_month, date_conv):
+    '''
+    Processes detailed raw text lines, adding usage info to 'lminfo' (already
+    initialized from the summary section).  date_conv is
+    lminfo.flexlm_start_date_to_ts, passed in so date handling lives in one
+    place.
+    '''
+    cdef int nwords
+
+    users_match = _USERS_RE.match
+
+    current_feature = None
+    current_version = None
+    current_entry = None
+    current_usage = None
+
+    for line in raw_det:
+
+        # Usage line; see lminfo._process_details for format samples and the
+        # explanation of the 9-word vs 10-word layouts.  Only usage lines
+        # contain ', start ', so nothing else pays for a split.
+        if ', start ' in line:
+
+            words = line.split()
+            nwords = len(words)
+
+            userid = words[0]
+            host_fullname = words[1]
+
+            if nwords == 10 and words[6] == 'start':
+                usage_ver = words[3]
+                usage_pid = words[5]
+                usage_date = words[8]
+                usage_time = words[9]
+            elif nwords == 9 and words[5] == 'start':
+                usage_ver = words[2]
+                usage_pid = words[4]
+                usage_date = words[7]
+                usage_time = words[8]
+            else:
+                continue
+
+            # intern repeated values; see lminfo._process_details
+            userid = intern(userid)
+            host = intern(host_fullname.split('.')[0])  # host.company.com=>host
+            ver = intern(usage_ver[2:-1])               # (v8.500)=>8.500
+            pid = usage_pid.partition(')')[0]           # 7581),=>7581
+            start = date_conv(usage_date, usage_time, yyyy, curr_month)
+
+            usage_entry = dict(userid=userid, host=host, pid=pid,
+                               start=start, sw_version=ver,
+                               lm_version=current_version)
+            current_usage.append(usage_entry)
+            current_entry['nused'] += 1
+            continue
+
+        if line.startswith("Users of "):
+            match = users_match(line)
+            if match:
+                current_feature = match.group(1)
+                continue
+
+        # Feature/version header, e.g.:
+        # "85527MAYAF" v1.000, vendor: adskflex, expiry: 1-jan-0
+        words = line.split()
+        if (len(words) == 6) and (words[2] == "vendor:"):
+
+            current_version = intern(words[1].strip('v,'))
+            current_entry = lminfo[current_feature + "_" + current_version]
+            if 'usage' not in current_entry:
+                current_entry['usage'] = []
+            current_usage = current_entry['usage']
@@ -2,16 +2,56 @@
 Module to implement Flexlm Parser.
 '''
 
+import calendar
 import json
-import os
 import re
+import subprocess
 import sys
 import time
 
+# Optional accelerator: orjson serializes large nested dicts far faster than
+# the stdlib pretty-printer (which is pure Python when indent is used).
+# Fall back to stdlib json when orjson isn't installed; output differs only
+# in indent width.
+#
+# Optional accelerator: compiled version of the _process_details parse loop
+# (see _flexlm_parse.pyx for what it covers and how to build it).  Used
+# automatically when present; the pure-Python loop below is the fallback and
+# the reference implementation.
+#
+try:
+    import _flexlm_parse as _accel
+except ImportError:
+    _accel = None
+
+try:
+    import orjson
+    def _dumps(obj):
+        ''' Serializes obj to indented json text via orjson. '''
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+except ImportError:
+    def _dumps(obj):
+        ''' Serializes obj to indented json text via stdlib json. '''
+        return json.dumps(obj, indent=4)
+
 class FlexlmError(Exception):
     ''' Minimal class to distinguish "expected" vs "unexpected" exceptions '''
     pass
 
+# Section-marker word tuples, built once so the per-line comparisons in
+# _preprocess() are plain tuple compares instead of re-splitting the marker
+# strings on every line.
+#
+_SUMMARY_HDR = ("Feature", "Version", "#licenses", "Expires", "Vendor")
+_SUMMARY_SEP = ("_______", "_________", "_________", "__________", "______")
+
+# Feature-usage header, e.g.:
+# "Users of 85527MAYA_F:  (Total of 5 licenses issued;  Total of 3 licenses in use)"
+# Compiled once here rather than per call in _process_details().
+#
+_USERS_RE = re.compile(r"Users of (\S+):\s+\(Total of (\d+) licenses? issued;  "
+                       r"Total of (\d+) licenses? in use\)")
+
 class ParseFlexlm(object):
 
     '''
@@ -21,16 +61,21 @@ class ParseFlexlm(object):
     The parser converts this into a well-structured json block.
     '''
 
-    def __init__(self, licfile='./flexlm.lic', output='json', verbose=True):
+    def __init__(self, licfile='./flexlm.lic', output='json', verbose=True,
+                 cache_ttl=0):
 
         self.licfile = licfile
         self.output = output        # Values: 'json', 'text', 'summary', 'details'
         self.verbose = verbose
+        self.cache_ttl = cache_ttl  # Raw-data cache lifetime in seconds
+                                    # (0 disables caching)
 
         self.lminfo = {}            # Dict to store license info by 'feature name'
         self.error = False
         self.error_msg = ""
 
+        self._raw_cache = (None, 0, [])   # (licfile, fetch time, raw lines)
+
 
     def get_license_info(self, licfile=None):
         '''
@@ -39,140 +84,205 @@ class ParseFlexlm(object):
         '''
         if licfile is None:
             licfile = self.licfile
-        raw_text = self._get_raw_license_text(licfile)
-        (raw_sum, raw_det) = self._preprocess(raw_text)
-        self._process_summary(raw_sum)
+        self.lminfo = {}    # Start fresh so repeated calls don't accumulate
+
+        # Grab "now" once per run; flexlm start dates omit the year, so the
+        # detail parser needs the current year/month for every usage line and
+        # shouldn't pay for a localtime() call each time.
+        now = time.localtime()
+        self._yyyy = now.tm_year
+        self._curr_month = now.tm_mon
+
+        lines = self._get_raw_license_lines(licfile)
+        raw_det = self._preprocess(lines)
+        # Drain whatever the scan didn't consume (it stops at a duplicate
+        # section) so a streaming source reaps its subprocess and caches.
+        for _unused in lines:
+            pass
         self._process_details(raw_det)
-        return json.dumps(self.lminfo, indent=4)
+        return _dumps(self.lminfo)
 
 
-    def _get_raw_license_text(self, licfile):
+    def _get_raw_license_lines(self, licfile):
         '''
         Runs the 'lmutil lmstat' command to query the license server, and
-        returns the resulting raw text data from stdout.
+        returns an iterator of raw text lines from stdout.  Lines are
+        streamed as the command produces them, so parsing overlaps the
+        subprocess I/O instead of waiting for the full (multi-MB) dump to
+        buffer up.  If cache_ttl is set and a recent-enough result for the
+        same license file is on hand, that is replayed instead of re-running
+        the (expensive) command -- useful for daemons that poll every few
+        seconds.
+
+        NOTE: with streaming, a command failure is only visible in
+        self.error once the iterator is exhausted.
         '''
-        cmd = './lmutil lmstat -c %s -a -i 2>&1' % (licfile)
-        # NOTE: '2>&1' gets stderr output in bash and cmd.exe shells
+        if self.cache_ttl:
+            (cached_licfile, cached_time, cached_lines) = self._raw_cache
+            if (cached_licfile == licfile and
+                    time.time() - cached_time < self.cache_ttl):
+                return iter(cached_lines)
+
+        cmd = ['./lmutil', 'lmstat', '-c', licfile, '-a', '-i']
+        # NOTE: stderr=STDOUT folds error text into the data stream, same as
+        #       the '2>&1' redirect the old shell-based version relied on.
+        #       A large bufsize keeps the pipe reads to a few big read()
+        #       syscalls instead of many line-sized ones.
 
         if self.verbose:
-            print >> sys.stderr, "running command: %s" % cmd
-        pipe = os.popen(cmd)
-        data = pipe.read()
-        stat = pipe.close()
-        if stat:
+            print >> sys.stderr, "running command: %s" % ' '.join(cmd)
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, bufsize=65536)
+        except OSError, err:
+            # Most common failure mode: ./lmutil is not in the current
+            # directory.  The shell used to report this through the pipe
+            # status; with Popen it surfaces as OSError instead.
             self.error = True
-            self.error_msg = stat
-            return ""
-        else:
-            return data
+            self.error_msg = "cannot run %s: %s" % (' '.join(cmd), err)
+            return iter([])
+        return self._stream_lines(proc, cmd, licfile)
 
 
-    def _preprocess(self, raw_text):
+    def _stream_lines(self, proc, cmd, licfile):
+        '''
+        Generator that yields stdout lines from the running lmutil process
+        (line endings stripped), then reaps it, recording any failure in
+        self.error/self.error_msg.  When cache_ttl is enabled the lines are
+        also collected and cached on success; otherwise nothing is retained
+        and each line is dropped as soon as the parser is done with it.
         '''
-        Performs preprocess on raw text data, splits text lines into 'summary',
-        and 'details' sections.  The summary section must be parsed first, but
-        appears at the end of the 'lmutil lmstat' output.  Summary contains
-        data for all licenses whereas the details section only has data for
-        licenses being used.
+        lines = [] if self.cache_ttl else None
+        for line in proc.stdout:
+            line = line.rstrip('\r\n')
+            if lines is not None:
+                lines.append(line)
+            yield line
+
+        proc.stdout.close()
+        proc.wait()
+        if proc.returncode:
+            self.error = True
+            self.error_msg = "command failed with status %d: %s" \
+                             % (proc.returncode, ' '.join(cmd))
+        elif lines is not None:
+            self._raw_cache = (licfile, time.time(), lines)
+
 
-        Returns (summary, details) tuple of text lines.
+    def _preprocess(self, lines):
+        '''
+        Performs a single pass over the raw text lines.  The summary section
+        must be parsed first, but appears at the end of the 'lmutil lmstat'
+        output, so detail lines are buffered for later while summary lines
+        (which arrive last, and contain data for all licenses rather than
+        just the ones in use) are fed to _process_summary_line() as they are
+        encountered.
+
+        Returns the list of details text lines.
         '''
 
         # Implement simple linear state machine to parse flexlm data sections
-        # states are: init -> feature_usage_info -> feature_summary_info
+        # states are: 0=init -> 1=feature_usage_info ->
+        #             2=feature_summary_header -> 3=feature_summary_info
         #
-        current_state = "init"
-        summary_lines = []        # License feature summary text lines
+        # Lines are classified by their first character before any stripping
+        # or splitting, so the bulk of the input (usage detail lines) is moved
+        # straight into its bucket without per-line string surgery.
+        #
+        state = 0
         details_lines = []        # License feature details text lines
 
-        for line in raw_text.split("\n"):
-
-            line = line.strip(' \t')
-            words = re.split(r'\s+', line)
+        for line in lines:
 
-            if current_state == "init":
-
-                if line == "Feature usage info:":
-                    current_state = "feature_usage_info"
+            if not line:
+                continue
 
-            elif current_state == "feature_usage_info":
+            if state == 1:
 
-                if words == "Feature Version #licenses Expires Vendor".split():
-                    current_state = "feature_summary_header"
+                # Section markers start at column 0 with 'F'; everything else
+                # in this section is detail data and needs no inspection.
+                if line[0] == 'F' and tuple(line.split()) == _SUMMARY_HDR:
+                    state = 2
                 else:
                     details_lines.append(line)
 
-            elif current_state == "feature_summary_header":
-
-                if words == "_______ _________ _________ __________ ______".split():
-                    #NOTE: this conditional is not future-proof (there have been
-                    #      changes in the separator line between versions).
-                    current_state = "feature_summary_info"
-
-            elif current_state == 'feature_summary_info':
+            elif state == 3:
 
                 # NOTE: "lmutil lmstat" sometimes gives duplicate data sets (reason unknown)
                 #       so, if a new section is encountered, quit parsing
                 #
-                if words[0:3] == "License server status:".split():
+                if line.startswith("License server status:"):
                     break
 
-                summary_lines.append(line)
+                self._process_summary_line(line.strip(' \t'))
+
+            elif state == 0:
+
+                if line[0] == 'F' and line.strip(' \t') == "Feature usage info:":
+                    state = 1
+
+            elif state == 2:
+
+                if line[0] == '_' and tuple(line.split()) == _SUMMARY_SEP:
+                    #NOTE: this conditional is not future-proof (there have been
+                    #      changes in the separator line between versions).
+                    state = 3
 
-        return (summary_lines, details_lines)
+        return details_lines
 
 
-    def _process_summary(self, raw_sum):
+    def _process_summary_line(self, line):
         '''
-        Processes summary raw text data, extracting the fields listed below for
-        each Flexlm license 'feature'.
+        Processes one line of summary raw text data, extracting the fields
+        listed below for the Flexlm license 'feature' it describes.
 
         Returns None, but:
-            Initializes self.lminfo as a list of dict, each element containing
-            the following key/values: feature, version, ntotal, nused=0,
-            expires, vendor, usage=[].
+            Adds an element to self.lminfo containing the following
+            key/values: feature, version, ntotal, nused=0, expires, vendor,
+            usage=[].
         '''
-        for line in raw_sum:
+        words = line.split()
 
-            words = re.split(r'\s+', line)
+        # Looking for lines like:
+        # "85527MAYA_F 1.000 5 1-jan-2015 adskflex"
 
-            # Looking for lines like:
-            # "85527MAYA_F 1.000 5 1-jan-2015 adskflex"
+        if len(words) == 5:
 
-            if len(words) == 5:
+            # intern() the values that repeat across entries (the vendor
+            # especially recurs for hundreds of features) so identical
+            # strings share a single object instead of one copy per line.
+            feature_name = words[0]
+            version = intern(words[1])
+            ntotal = int(words[2])
+            expires = convert_expiration_date(words[3])
+            vendor = intern(words[4])
 
-                feature_name = words[0]
-                version = words[1]
-                ntotal = int(words[2])
-                expires = convert_expiration_date(words[3])
-                vendor = words[4]
+            feature_uniq = feature_name + "_" + version
 
-                feature_uniq = feature_name + "_" + version
+            # HACK ALERT:
+            # if feature_uniq already exists, take the earliest expiration
+            # date, add the ntotals.  This will help get the right total in
+            # the case that there are additional feature entries with the
+            # same name and version number, but which have a different
+            # expiration date. We combine them because flexlm's usage info
+            # doesn't seem to distinguish between such 'overlapping feature-
+            # versions'. Sigh.
 
-                # HACK ALERT:
-                # if feature_uniq already exists, take the earliest expiration
-                # date, add the ntotals.  This will help get the right total in
-                # the case that there are additional feature entries with the
-                # same name and version number, but which have a different
-                # expiration date. We combine them because flexlm's usage info
-                # doesn't seem to distinguish between such 'overlapping feature-
-                # versions'. Sigh.
+            if feature_uniq in self.lminfo:
 
-                if feature_uniq in self.lminfo:
+                self.lminfo[feature_uniq]['ntotal'] += ntotal
 
-                    self.lminfo[feature_uniq]['ntotal'] += ntotal
-
-                else:
-                    self.lminfo[feature_uniq] = dict(
-                        feature=feature_name, version=version, ntotal=ntotal,
-                        expires=expires, vendor=vendor, nused=0, usage=[],
-                        )
+            else:
+                self.lminfo[feature_uniq] = dict(
+                    feature=feature_name, version=version, ntotal=ntotal,
+                    expires=expires, vendor=vendor, nused=0, usage=[],
+                    )
 
 
     def _process_details(self, raw_det):
         '''
         Processes detailed raw text data, adds usage information to 'lminfo'
-        initialized by _process_summary().
+        initialized by _process_summary_line().
 
         Returns None, but also:
             Adds 'usage' key/value to each element of self.lminfo for which
@@ -184,39 +294,26 @@ class ParseFlexlm(object):
         # Process the details text info, extract per-feature usage info.
         # The text lines appear in a 3-level hierarchy: feature/version/usage
 
-        for line in raw_det:
-
-            words = re.split(r'\s+', line)
-
-            fu_re = r"Users of (\S+):\s+\(Total of (\d+) licenses? issued;  " \
-                    r"Total of (\d+) licenses? in use\)"
-            match = re.match(fu_re, line)
-            if match:
-
-                current_feature = match.group(1)
-                #current_total = match.group(2)
-                #current_used = match.group(3)
-                continue
+        if _accel is not None:
+            _accel.process_details(raw_det, self.lminfo, self._yyyy,
+                                   self._curr_month, flexlm_start_date_to_ts)
+            return
 
-            # Looking for lines like:
-            # "85527MAYAF" v1.000, vendor: adskflex, expiry: 1-jan-0
-            if (len(words) == 6) and (words[2] == "vendor:"):
-
-                #redundant_feature_name = words[0]
-                current_version = words[1].strip('v,')
-                #current_vendor = words[3]
-
-                current_feature_uniq = current_feature + "_" + current_version
-
-                #NOTE: Only needed if summary is missing features,
-                #NOTE: does this ever happen?
-                if 'usage' not in self.lminfo[current_feature_uniq]:
-                    self.lminfo[current_feature_uniq]['usage'] = []
-                continue
+        # Bind hot names to locals; global and attribute lookups cost a dict
+        # probe per iteration in CPython and this loop runs once per line.
+        lminfo = self.lminfo
+        users_match = _USERS_RE.match
+        date_conv = flexlm_start_date_to_ts
+        yyyy = self._yyyy
+        curr_month = self._curr_month
 
+        for line in raw_det:
 
             #pylint: disable=line-too-long
-            # Looking for lines like:
+            # Usage lines -- the overwhelming majority of the input -- all
+            # contain ', start ', and nothing else does, so that substring
+            # check routes each line to its branch before any splitting.
+            # They look like:
             # "someguy ahost ahost (v1.000) (imdlic01/7111 7581), start Wed 9/12 9:08",
             #
             # or lines like:
@@ -227,8 +324,10 @@ class ParseFlexlm(object):
             # (if machine name is too long, flexlm omits double-print of machine
             # and all subsequent fields are shifted left by 1 position, yuck.
 
-            nwords = len(words)
-            if nwords == 9 or nwords == 10:
+            if ', start ' in line:
+
+                words = line.split()
+                nwords = len(words)
 
                 userid = words[0]
                 host_fullname = words[1]
@@ -247,17 +346,54 @@ class ParseFlexlm(object):
                 else:
                     continue
 
-                # Apply further string/data-conversions as needed
-                host = host_fullname.split('.')[0]    # host.company.com=>host
-                ver = usage_ver.strip('()').lstrip('v')     # (v8.500)=>8.500
-                pid = usage_pid.rstrip('),')                # 7581),=>7581
-                start = flexlm_start_date_to_ts(usage_date, usage_time)
+                # Apply further string/data-conversions as needed.  The
+                # surrounding formats are fixed, so positional slicing beats
+                # the generic strip chains (which re-scan the string once
+                # per strip call).
+                # userid/host/version repeat across a user's many checkouts;
+                # intern them so each distinct value is stored once.
+                userid = intern(userid)
+                host = intern(host_fullname.split('.')[0])  # host.company.com=>host
+                ver = intern(usage_ver[2:-1])               # (v8.500)=>8.500
+                pid = usage_pid.partition(')')[0]           # 7581),=>7581
+                start = date_conv(usage_date, usage_time, yyyy, curr_month)
 
                 # Add usage entry to lminfo, maintain used-license count
                 usage_entry = dict(userid=userid, host=host, pid=pid,
                                    start=start, sw_version=ver, lm_version=current_version)
-                self.lminfo[current_feature_uniq]['usage'].append(usage_entry)
-                self.lminfo[current_feature_uniq]['nused'] += 1
+                current_usage.append(usage_entry)
+                current_entry['nused'] += 1
+                continue
+
+            # Feature-usage header, checked before splitting since the
+            # prefix identifies it outright.
+            if line.startswith("Users of "):
+                match = users_match(line)
+                if match:
+                    current_feature = match.group(1)
+                    #current_total = match.group(2)
+                    #current_used = match.group(3)
+                    continue
+
+            # Looking for lines like:
+            # "85527MAYAF" v1.000, vendor: adskflex, expiry: 1-jan-0
+            words = line.split()
+            if (len(words) == 6) and (words[2] == "vendor:"):
+
+                #redundant_feature_name = words[0]
+                current_version = intern(words[1].strip('v,'))
+                #current_vendor = words[3]
+
+                # Grab direct references to the feature's entry and usage
+                # list here, so the (much more numerous) usage lines above
+                # don't re-do the hashed dict lookups for every checkout.
+                current_entry = lminfo[current_feature + "_" + current_version]
+
+                #NOTE: Only needed if summary is missing features,
+                #NOTE: does this ever happen?
+                if 'usage' not in current_entry:
+                    current_entry['usage'] = []
+                current_usage = current_entry['usage']
 
 
 
@@ -269,6 +405,19 @@ class ParseFlexlm(object):
 # ts = "Time String", human-readable date/time, e.g. "2008-06-10 10:04 (Tue)"
 # tv = "Time Value", time value array, e.g. (2008, 6, 10, 10, 5, 53, 1, 162, 1)
 
+# Month-name lookup for the hand-rolled "dd-mmm-yyyy" parser below.
+# time.strptime is one of the slowest stdlib calls (and takes a lock); a
+# dict lookup plus int() does the same conversion for our fixed format.
+#
+_MONTHS = dict(jan=1, feb=2, mar=3, apr=4, may=5, jun=6,
+               jul=7, aug=8, sep=9, oct=10, nov=11, dec=12)
+
+# Memo table for convert_expiration_date(). License files repeat a handful
+# of distinct expiration dates across hundreds of features, so the parse
+# only ever runs once per distinct date.
+#
+_exp_date_cache = {}
+
 def convert_expiration_date(exp_date):
     '''
     Converts Flexlm, PixarAdmin, Sesi expiration date format to the far more
@@ -276,35 +425,61 @@ def convert_expiration_date(exp_date):
     Accepts "dd-mmm-yyyy" and produces "YYYY-MM-DD HH:MM"
     Example "1-oct-2007" => "2007-10-01 23:59"
     (assumes exact expiration time is midnight on expiration date)
+    Results are memoized, since input dates repeat heavily.
     '''
+    if exp_date in _exp_date_cache:
+        return _exp_date_cache[exp_date]
+
     try:
-        tv_exp = time.strptime(exp_date+" 23:59", "%d-%b-%Y %H:%M")
-        ts_out = time.strftime("%Y-%m-%d %H:%M", tv_exp)
+        if (exp_date == "1-jan-0") or (exp_date == "01-jan-0000"):
+            # Exactly these two spellings are FlexLm's way of saying
+            # "permanent"; any other year-0 date is rejected below, as
+            # strptime used to do.
+            ts_out = "9999-12-31 23:59"
+        else:
+            (day, mon, year) = exp_date.split('-')
+            day = int(day)
+            year = int(year)
+            month = _MONTHS[mon.lower()]
+            # calendar.monthrange gives the month's real last day (leap
+            # years included), matching strptime's date validation.
+            if year != 0 and 1 <= day <= calendar.monthrange(year, month)[1]:
+                ts_out = "%04d-%02d-%02d 23:59" % (year, month, day)
+            else:
+                ts_out = "xxxx-xx-xx xx:xx"
     #except ValueError:
     # pylint: disable=broad-except
     #
     except Exception:
-        # Explicitly handle case of "1-jan-0" expiration date (FlexLm)
-        if (exp_date == "1-jan-0") or (exp_date == "01-jan-0000"):
-            ts_out = "9999-12-31 23:59"
-        else:
-            ts_out = "xxxx-xx-xx xx:xx"
+        ts_out = "xxxx-xx-xx xx:xx"
+
+    _exp_date_cache[exp_date] = ts_out
     return ts_out
 
 
-def flexlm_start_date_to_ts(mmdd, hhmm):
+def flexlm_start_date_to_ts(mmdd, hhmm, yyyy, curr_month):
     '''
     Converts Flexlm start date format to the far more useful human-readable and
-    machine-sortable 'ts' time string format.
+    machine-sortable 'ts' time string format.  The caller supplies the current
+    year and month (computed once per run) since flexlm start dates omit the
+    year; a start month later than the current month means the checkout
+    happened last year (December->January rollover).
 
-    Accepts "mm/dd hh:mm" and produces "YYYY-MM-DD HH:MM"
-    Example "9/13 12:51" => "2007-09-13 12:51"
+    Accepts "mm/dd hh:mm" and produces "YYYY-MM-DD HH:MM (Day)"
+    Example "9/13 12:51" => "2007-09-13 12:51 (Thu)"
     '''
     try:
-        yyyy = time.strftime("%Y", time.localtime())
-        tv_start = time.strptime(mmdd+"/"+yyyy+" "+hhmm, "%m/%d/%Y %H:%M")
-        tv_start = adjust_year(tv_start, yyyy)
-        ts_out = time.strftime("%Y-%m-%d %H:%M (%a)", tv_start)
+        (month, day) = mmdd.split('/')
+        (hour, minute) = hhmm.split(':')
+        month = int(month)
+        day = int(day)
+        if month > curr_month:
+            yyyy -= 1
+        # calendar.weekday is pure arithmetic; it also validates the date,
+        # raising ValueError like strptime would for garbage input.
+        day_name = calendar.day_abbr[calendar.weekday(yyyy, month, day)]
+        ts_out = "%04d-%02d-%02d %02d:%02d (%s)" \
+                 % (yyyy, month, day, int(hour), int(minute), day_name)
     #except ValueError:
     # pylint: disable=broad-except
     except Exception:
@@ -312,20 +487,3 @@ def flexlm_start_date_to_ts(mmdd, hhmm):
 
     return ts_out
 
-
-def adjust_year(tv_start, yyyy):
-    '''
-    License manager start dates do not include a year number, so we assume the
-    current year. This leads to a potential year rollover problem, e.g. when a
-    license is checked out in December but still out in January. We fix it by
-    checking if the month > current month, and decrementing the year if needed.
-    '''
-    tv_adjusted = tv_start
-    input_month = time.strftime("%m", tv_start)
-    curr_month = time.strftime("%m", time.localtime())
-    if input_month > curr_month:
-        yyyy -= 1
-        tv_adjusted = time.strptime(tv_start+" "+yyyy, "%d-%b-%H:%M %Y")
-
-    return tv_adjusted
-